@@ -3,8 +3,16 @@
 import serial
 import serial.tools.list_ports
 import threading
+import array
+import queue
+import selectors
+import sched
 import time
+import signal
 import csv
+import os
+import struct
+import sys
 from datetime import datetime
 
 # Conversion factor for CPM to µSv/h
@@ -12,12 +20,36 @@ def convert_cpm_to_usvh(cpm):
     return cpm * 0.0065
 
 CSV_FILENAME = "geiger_log.csv"
-GPS_COORDS = "53.4096, -2.5737"
+# Quoted once here since rows are written without the csv module
+GPS_COORDS = '"53.4096, -2.5737"'
+_GPS_BYTES = GPS_COORDS.encode()
+# Set to True to print raw device replies
+DEBUG = False
 
-# Global lock for thread-safe serial writes
-serial_lock = threading.Lock()
-# Global variable for the latest battery voltage (default to 0.0)
-last_batt_voltage = 0.0
+# Device commands
+_CMD_WAKE = b'\r\n'
+_CMD_GETVER = b'<GETVER>>'
+_CMD_GETSERIAL = b'<GETSERIAL>>'
+_CMD_GETVOLT = b'<GETVOLT>>'
+_CMD_GETCPM = b'<GETCPM>>'
+# Big-endian 16-bit CPM count from a <GETCPM>> reply
+_CPM_STRUCT = struct.Struct(">H")
+# Latest battery voltage in a single float slot shared between threads (default to 0.0)
+_batt = array.array('d', [0.0])
+# Cached (second, encoded timestamp) pair for format_timestamp
+_ts_cache = (None, b"")
+# Rows waiting to be appended to the CSV by the writer thread
+log_q = queue.Queue(maxsize=1024)
+# Set when a reply came back short, empty, over-long or with an error, so stray bytes may follow
+_rx_dirty = False
+# Set by the SIGINT/SIGTERM handler to shut the poll thread down
+stop_event = threading.Event()
+# Write buffered rows to disk once this many bytes or seconds accumulate, whichever comes first
+FLUSH_BYTES = 4096
+FLUSH_SECONDS = 60
+# Serial read timeouts for the polling loop, in seconds
+SERIAL_TIMEOUT = 0.3
+SERIAL_INTER_BYTE_TIMEOUT = 0.05
 
 def initialize_csv(filename):
     try:
@@ -27,17 +59,72 @@ def initialize_csv(filename):
             writer.writerow(["Timestamp", "CPM", "uSv/h", "Battery Voltage", "GPS", "Device Serial", "Device Version"])
     except FileExistsError:
         pass
+    # Keep one descriptor open for the life of the process instead of reopening per write.
+    fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+    return fd
 
-def log_data(filename, timestamp, cpm, usvh, batt_voltage, device_serial, device_version):
-    # If batt_voltage is not a number, default to 0.0.
-    if not isinstance(batt_voltage, (int, float)):
-        batt_voltage = 0.0
-    batt_str = f"{batt_voltage:.2f}"
-    with open(filename, 'a', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow([timestamp.isoformat(), cpm, usvh, batt_str, GPS_COORDS, device_serial, device_version])
+def format_timestamp(t):
+    # Format a time.time() value as an encoded local ISO timestamp, reusing it within the same second.
+    global _ts_cache
+    sec = int(t)
+    cached_sec, cached_ts = _ts_cache
+    if sec != cached_sec:
+        cached_ts = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(sec)).encode()
+        _ts_cache = (sec, cached_ts)
+    return cached_ts
+
+def log_data(ts, cpm, usvh, batt_voltage, device_serial, device_version):
+    # ts, device_serial and device_version are already-encoded bytes.
+    row = (ts, cpm, usvh, batt_voltage, device_serial, device_version)
+    try:
+        log_q.put_nowait(row)
+    except queue.Full:
+        # Writer has fallen behind; drop the oldest row to make room.
+        try:
+            log_q.get_nowait()
+        except queue.Empty:
+            pass
+        log_q.put_nowait(row)
     # Minimal terminal output for logging; remove or comment out the next line if desired.
-    # print(f"Logged: {timestamp.isoformat()}, CPM: {cpm}, uSv/h: {usvh:.2f}, Batt: {batt_str} V, Serial: {device_serial}, Version: {device_version}")
+    # print(f"Logged: {ts.decode()}, CPM: {cpm}, uSv/h: {usvh:.2f}, Batt: {batt_voltage:.2f} V, Serial: {device_serial.decode()}, Version: {device_version.decode()}")
+
+def flush_buffer(fd, buf):
+    # Append the buffered rows and make sure they reach the SD card. Written bytes are
+    # removed as they go, so after a short write or an error the rest is retried next flush.
+    if not buf:
+        return
+    try:
+        while buf:
+            del buf[:os.write(fd, buf)]
+        if hasattr(os, 'fdatasync'):
+            os.fdatasync(fd)
+        else:
+            os.fsync(fd)
+    except OSError as e:
+        print("Error writing CSV data:", e)
+
+def csv_writer_loop(fd):
+    # Rows collect in memory and go to disk in batches rather than per row.
+    # The row layout is fixed, so format it straight to bytes instead of going through csv.writer.
+    buf = bytearray()
+    last_flush = time.monotonic()
+    try:
+        while True:
+            try:
+                row = log_q.get(timeout=1)
+                # main queues None once the poller has stopped, so every earlier row is written first.
+                if row is None:
+                    break
+                ts, cpm, usvh, batt_voltage, device_serial, device_version = row
+                buf += b"%s,%d,%.2f,%.2f,%s,%s,%s\r\n" % (
+                    ts, cpm, usvh, batt_voltage, _GPS_BYTES, device_serial, device_version)
+            except queue.Empty:
+                pass
+            if len(buf) >= FLUSH_BYTES or time.monotonic() - last_flush >= FLUSH_SECONDS:
+                flush_buffer(fd, buf)
+                last_flush = time.monotonic()
+    finally:
+        flush_buffer(fd, buf)
 
 def get_serial_port():
     ports = serial.tools.list_ports.comports()
@@ -45,130 +132,203 @@ def get_serial_port():
         return ports[0].device
     return None
 
+def set_low_latency(ser):
+    # Ask the Linux USB-serial driver to pass bytes on immediately instead of batching them for ~16 ms.
+    # pyserial has no such call on Windows and raises NotImplementedError on other POSIX systems.
+    if not hasattr(ser, 'set_low_latency_mode'):
+        return
+    try:
+        ser.set_low_latency_mode(True)
+    except NotImplementedError:
+        pass
+    except (OSError, ValueError) as e:
+        print("Could not enable low-latency mode:", e)
+
 def get_device_version(ser):
-    with serial_lock:
-        ser.write(b'\r\n')
-        time.sleep(0.2)
-        ser.write(b'<GETVER>>')
-    time.sleep(0.5)
+    ser.write(_CMD_WAKE)
+    time.sleep(0.2)
+    ser.write(_CMD_GETVER)
     version = ser.readline().decode('utf-8', errors='replace').strip()
     return version
 
 def get_device_serial_number(ser):
-    with serial_lock:
-        ser.write(b'<GETSERIAL>>')
+    ser.write(_CMD_GETSERIAL)
     time.sleep(0.5)
     data = ser.read(7)
-    if len(data) == 7:
-        serial_str = ''.join(f"{byte:02X}" for byte in data)
-        return serial_str
-    return "Unknown"
+    return data.hex().upper() if len(data) == 7 else "Unknown"
 
-def set_device_datetime(ser):
+def set_device_datetime(ser, sel):
     now = datetime.now()
-    YY = f"{now.year % 100:02X}"
-    MM = f"{now.month:02X}"
-    DD = f"{now.day:02X}"
-    hh = f"{now.hour:02X}"
-    mm = f"{now.minute:02X}"
-    ss = f"{now.second:02X}"
-    cmd = f"<SETDATETIME{YY}{MM}{DD}{hh}{mm}{ss}>>"
-    with serial_lock:
-        ser.write(cmd.encode())
-    print(f"Set device datetime with command: {cmd}")
-
-def sync_time_loop(ser):
-    while ser.is_open:
-        set_device_datetime(ser)
-        time.sleep(1800)  # 30 minutes
-
-def read_battery_voltage_loop(ser):
-    global last_batt_voltage
-    while ser.is_open:
-        try:
+    # All fields are two-digit hex; build the command in one bytes format.
+    cmd = b"<SETDATETIME%02X%02X%02X%02X%02X%02X>>" % (
+        now.year % 100, now.month, now.day, now.hour, now.minute, now.second)
+    send_command(ser, sel, cmd, 0)
+    print(f"Set device datetime with command: {cmd.decode()}")
+
+def open_selector(ser):
+    # Watch the port's file descriptor for incoming data; not available on Windows.
+    try:
+        sel = selectors.DefaultSelector()
+        sel.register(ser.fileno(), selectors.EVENT_READ)
+        return sel
+    except (OSError, ValueError):
+        return None
+
+def send_command(ser, sel, cmd, n):
+    # Write one command and read its n-byte reply (n=0 means the command has no reply).
+    # The input buffer is only flushed when stray bytes may be pending: after a bad read, whose
+    # reply can still arrive late, or when bytes are already waiting. A good read leaves it empty.
+    global _rx_dirty
+    try:
+        if _rx_dirty or ser.in_waiting:
             ser.reset_input_buffer()
-            with serial_lock:
-                ser.write(b'<GETVOLT>>')
-            time.sleep(0.5)
-            response = ser.read(1)
-            if len(response) == 1:
-                voltage = response[0] / 10.0
-                # For a LiPo AAA cell, expect voltage below 5V.
-                if voltage > 5.0:
-                    print(f"Invalid battery voltage reading: {voltage:.2f} V; setting to 0.0 V.")
-                    last_batt_voltage = 0.0
-                else:
-                    last_batt_voltage = voltage
-                    # Uncomment next line for debug: print(f"Battery Voltage: {voltage:.2f} V")
-            else:
-                print("Incomplete battery voltage data; setting battery voltage to 0.0 V.")
-                last_batt_voltage = 0.0
-        except Exception as e:
-            print("Error in battery voltage loop:", e)
-            last_batt_voltage = 0.0
-        time.sleep(60)  # Poll battery voltage every 60 seconds
+            _rx_dirty = False
+        ser.write(cmd)
+        if n == 0:
+            return b''
+        # Wait once for the first byte; if none comes there is no reply, so skip the blocking read.
+        if sel is not None and not ser.in_waiting and not sel.select(ser.timeout):
+            response = b''
+        else:
+            # The rest of the reply follows back to back, bounded by inter_byte_timeout.
+            response = ser.read(n)
+        # Drop a leading 0xAA marker/ack byte left ahead of the reply and read the byte it
+        # displaced. As a 1-byte GETVOLT reply it would read as 17.0 V, which is never valid anyway.
+        if response[:1] == b'\xaa':
+            full = len(response) == n
+            response = response[1:]
+            if full:
+                response += ser.read(1)
+        # Bytes left over mean this reply is mixed up with another one; never decode it.
+        if len(response) != n or ser.in_waiting:
+            _rx_dirty = True
+            return b''
+    except Exception:
+        _rx_dirty = True
+        raise
+    return response
 
-def read_cpm_loop(ser, device_serial, device_version):
-    while ser.is_open:
+def _handle_volt(response):
+    if len(response) == 1:
+        voltage = response[0] / 10.0
+        # For a LiPo AAA cell, expect voltage below 5V.
+        if voltage > 5.0:
+            print(f"Invalid battery voltage reading: {voltage:.2f} V; setting to 0.0 V.")
+            _batt[0] = 0.0
+        else:
+            _batt[0] = voltage
+            # Uncomment next line for debug: print(f"Battery Voltage: {voltage:.2f} V")
+    else:
+        print("Incomplete battery voltage data; setting battery voltage to 0.0 V.")
+        _batt[0] = 0.0
+
+def _handle_cpm(response, device_serial, device_version):
+    if DEBUG:
+        print(f"[CPM Raw bytes]: {response}")
+    if len(response) == 2:
+        cpm_value = _CPM_STRUCT.unpack_from(response, 0)[0] & 0x3FFF
+        usvh = convert_cpm_to_usvh(cpm_value)
+        ts = format_timestamp(time.time())
+        log_data(ts, cpm_value, usvh, _batt[0], device_serial, device_version)
+    else:
+        print("No valid CPM data received")
+
+def schedule_every(s, interval, priority, action):
+    # Run action now and then every interval seconds, against absolute deadlines so drift does not accumulate.
+    def run(deadline):
         try:
-            ser.reset_input_buffer()
-            with serial_lock:
-                ser.write(b'<GETCPM>>')
-            time.sleep(2)
-            # Try to read exactly 2 bytes (or 3 if an extra marker is present)
-            response = ser.read(2)
-            if len(response) < 2:
-                extra = ser.read(1)
-                response += extra
-            print(f"[CPM Raw bytes]: {response}")
-            if response:
-                if len(response) >= 2:
-                    valid_response = response[:2]
-                    cpm_value = int.from_bytes(valid_response, byteorder='big') & 0x3FFF
-                    usvh = convert_cpm_to_usvh(cpm_value)
-                    timestamp = datetime.now()
-                    batt_voltage = last_batt_voltage if last_batt_voltage is not None else 0.0
-                    log_data(CSV_FILENAME, timestamp, cpm_value, round(usvh, 2), batt_voltage, device_serial, device_version)
-                elif len(response) == 1:
-                    if response == b'\xaa':
-                        print("Ignoring marker byte 0xAA")
-                    else:
-                        print("Unexpected 1-byte response:", response)
-            else:
-                print("No CPM data received")
+            action()
         except Exception as e:
-            print("Error in CPM loop:", e)
+            print(f"Error in {action.__name__}:", e)
+        if not stop_event.is_set():
+            s.enterabs(deadline + interval, priority, run, (deadline + interval,))
+
+    start = time.monotonic()
+    s.enterabs(start, priority, run, (start,))
+
+def poll_loop(ser, device_serial, device_version):
+    # Single thread owning the serial port; commands run one at a time so replies cannot interleave.
+    sel = open_selector(ser)
+    # Encoded once here rather than for every logged row.
+    device_serial = device_serial.encode()
+    device_version = device_version.encode()
+
+    def do_sync():
+        set_device_datetime(ser, sel)
+
+    def do_volt():
+        _handle_volt(send_command(ser, sel, _CMD_GETVOLT, 1))
+
+    def do_cpm():
+        _handle_cpm(send_command(ser, sel, _CMD_GETCPM, 2), device_serial, device_version)
+
+    s = sched.scheduler(time.monotonic, time.sleep)
+    schedule_every(s, 1800, 1, do_sync)  # Sync device time every 30 minutes
+    schedule_every(s, 60, 2, do_volt)    # Poll battery voltage every 60 seconds
+    schedule_every(s, 4, 3, do_cpm)      # Poll CPM every 4 seconds
+    # Sleep on the stop event rather than time.sleep so shutdown does not wait for the next poll.
+    while not stop_event.is_set():
+        delay = s.run(blocking=False)
+        if delay is None:
             break
-        time.sleep(4)  # Poll every 4 seconds
+        stop_event.wait(delay)
+
+def request_stop(signum, frame):
+    stop_event.set()
 
 def main():
-    initialize_csv(CSV_FILENAME)
+    # Installed first so Ctrl-C during startup also stops cleanly instead of raising KeyboardInterrupt.
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+    csv_fd = initialize_csv(CSV_FILENAME)
     port = get_serial_port()
     if port is None:
         print("No serial port found. Ensure the device is connected.")
+        os.close(csv_fd)
         return
     print(f"Using serial port: {port}")
+    writer = None
     try:
-        ser = serial.Serial(port, 57600, timeout=1,
+        # Reads return as soon as the requested bytes arrive, or after the timeout.
+        ser = serial.Serial(port, 57600, timeout=SERIAL_TIMEOUT, inter_byte_timeout=SERIAL_INTER_BYTE_TIMEOUT,
                             parity=serial.PARITY_NONE,
                             bytesize=serial.EIGHTBITS,
                             stopbits=serial.STOPBITS_ONE)
-        time.sleep(2)
+        set_low_latency(ser)
+        stop_event.wait(2)
         print(f"Connected to {port}")
 
+        # Identification runs once, so give the device plenty of time to reply; the
+        # GETVER reply has no newline, so readline() only returns on the timeout.
+        ser.timeout, ser.inter_byte_timeout = 1, None
         device_version = get_device_version(ser)
         print(f"Device version: {device_version}")
         device_serial = get_device_serial_number(ser)
         print(f"Device serial number: {device_serial}")
+        ser.timeout, ser.inter_byte_timeout = SERIAL_TIMEOUT, SERIAL_INTER_BYTE_TIMEOUT
 
-        threading.Thread(target=sync_time_loop, args=(ser,), daemon=True).start()
-        threading.Thread(target=read_battery_voltage_loop, args=(ser,), daemon=True).start()
-        threading.Thread(target=read_cpm_loop, args=(ser, device_serial, device_version), daemon=True).start()
+        writer = threading.Thread(target=csv_writer_loop, args=(csv_fd,), daemon=True)
+        poller = threading.Thread(target=poll_loop, args=(ser, device_serial, device_version), daemon=True)
+        writer.start()
+        poller.start()
 
-        while True:
-            time.sleep(1)
+        if sys.platform == 'win32':
+            # Lock waits are not interrupted by Ctrl-C on Windows, so wake periodically to let the handler run.
+            while not stop_event.wait(1):
+                pass
+        else:
+            stop_event.wait()
+        print("Stopping; flushing buffered rows.")
+        poller.join(timeout=5)
+        log_q.put(None)
+        writer.join(timeout=5)
+        ser.close()
     except Exception as e:
         print("Error connecting to serial port:", e)
+    finally:
+        # Only close the CSV once the writer is done with it; if it is still stuck, exit closes it.
+        if writer is None or not writer.is_alive():
+            os.close(csv_fd)
 
 if __name__ == "__main__":
     main()